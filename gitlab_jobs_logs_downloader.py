@@ -5,14 +5,17 @@
 
 """Gitlab Jobs Logs Downloader"""
 
+import asyncio
 import logging
 import os
 import sys
-import time
 from datetime import datetime
+from functools import lru_cache
+from operator import itemgetter
+from pathlib import Path
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-import pytz
-import requests
+import aiohttp
 from slugify import slugify
 
 GITLAB_JOBS_LOGS_DOWNLOADER_LOGLEVEL = os.environ.get(
@@ -26,6 +29,8 @@ GITLAB_JOBS_LOGS_DOWNLOADER_FILENAME_DELIMITER = os.environ.get(
     "GITLAB_JOBS_LOGS_DOWNLOADER_FILENAME_DELIMITER", "#"
 )
 
+# Maximum interval between two job checks: running & ending jobs are polled
+# with an exponential backoff (1s, 2s, 4s, ...) capped to this value
 try:
     GITLAB_JOBS_LOGS_DOWNLOADER_JOB_CHECK_INTERVAL_SECONDS = int(
         os.environ.get("GITLAB_JOBS_LOGS_DOWNLOADER_JOB_CHECK_INTERVAL_SECONDS", "10")
@@ -54,6 +59,39 @@ except ValueError:
     logging.error("GITLAB_JOBS_LOGS_DOWNLOADER_END_JOB_TIMEOUT_SECONDS must be int !")
     os._exit(1)
 
+try:
+    GITLAB_JOBS_LOGS_DOWNLOADER_MAX_CONCURRENCY = int(
+        os.environ.get("GITLAB_JOBS_LOGS_DOWNLOADER_MAX_CONCURRENCY", "5")
+    )
+    if GITLAB_JOBS_LOGS_DOWNLOADER_MAX_CONCURRENCY < 1:
+        raise ValueError
+except ValueError:
+    logging.error("GITLAB_JOBS_LOGS_DOWNLOADER_MAX_CONCURRENCY must be int >= 1 !")
+    os._exit(1)
+
+try:
+    GITLAB_JOBS_LOGS_DOWNLOADER_MAX_RETRIES = int(
+        os.environ.get("GITLAB_JOBS_LOGS_DOWNLOADER_MAX_RETRIES", "5")
+    )
+except ValueError:
+    logging.error("GITLAB_JOBS_LOGS_DOWNLOADER_MAX_RETRIES must be int !")
+    os._exit(1)
+
+# Trace download chunk size & file write buffer size (bytes)
+CHUNK_SIZE = 64 * 1024
+BUFFER_SIZE = 1024 * 1024
+
+# Gitlab API connect & read (between two chunks) timeouts (seconds),
+# no total timeout since large traces can take long to download
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 300
+
+# Connections kept free from trace downloads for jobs polling
+API_CONNECTIONS = 5
+
+# HTTP status codes of Gitlab API requests to retry
+RETRY_STATUS_CODES = [429, 502, 503, 504]
+
 # CI_API_TOKEN must be the last element of MANDATORY_ENV_VARS (hide secret)
 MANDATORY_ENV_VARS = [
     "CI_PROJECT_ID",
@@ -64,28 +102,27 @@ MANDATORY_ENV_VARS = [
 
 # Logging Configuration
 try:
-    pytz.timezone(GITLAB_JOBS_LOGS_DOWNLOADER_TZ)
-    logging.Formatter.converter = lambda *args: datetime.now(
-        tz=pytz.timezone(GITLAB_JOBS_LOGS_DOWNLOADER_TZ)
-    ).timetuple()
+    TIMEZONE = ZoneInfo(GITLAB_JOBS_LOGS_DOWNLOADER_TZ)
+except (ZoneInfoNotFoundError, ValueError):
+    TIMEZONE = ZoneInfo("Europe/Paris")
+    logging.Formatter.converter = lambda *args: datetime.now(tz=TIMEZONE).timetuple()
     logging.basicConfig(
         stream=sys.stdout,
         format="%(asctime)s - %(levelname)s - %(message)s",
         datefmt="%d/%m/%Y %H:%M:%S",
-        level=GITLAB_JOBS_LOGS_DOWNLOADER_LOGLEVEL,
+        level="INFO",
     )
-except pytz.exceptions.UnknownTimeZoneError:
-    logging.Formatter.converter = lambda *args: datetime.now(
-        tz=pytz.timezone("Europe/Paris")
-    ).timetuple()
+    logging.error("TZ invalid : %s !", GITLAB_JOBS_LOGS_DOWNLOADER_TZ)
+    os._exit(1)
+
+logging.Formatter.converter = lambda *args: datetime.now(tz=TIMEZONE).timetuple()
+try:
     logging.basicConfig(
         stream=sys.stdout,
         format="%(asctime)s - %(levelname)s - %(message)s",
         datefmt="%d/%m/%Y %H:%M:%S",
-        level="INFO",
+        level=GITLAB_JOBS_LOGS_DOWNLOADER_LOGLEVEL,
     )
-    logging.error("TZ invalid : %s !", GITLAB_JOBS_LOGS_DOWNLOADER_LOGLEVEL)
-    os._exit(1)
 except ValueError:
     logging.basicConfig(
         stream=sys.stdout,
@@ -96,11 +133,12 @@ except ValueError:
     logging.error("GITLAB_JOBS_LOGS_DOWNLOADER_LOGLEVEL invalid !")
     os._exit(1)
 
-# Check Mandatory Environment Variable
-for var in MANDATORY_ENV_VARS:
-    if var not in os.environ:
+# Check Mandatory Environment Variables
+MISSING_ENV_VARS = [var for var in MANDATORY_ENV_VARS if var not in os.environ]
+if MISSING_ENV_VARS:
+    for var in MISSING_ENV_VARS:
         logging.critical("%s environment variable must be set !", var)
-        os._exit(1)
+    os._exit(1)
 
 CI_API_TOKEN = os.environ.get("CI_API_TOKEN")
 CI_API_V4_URL = os.environ.get("CI_API_V4_URL")
@@ -108,81 +146,158 @@ CI_PROJECT_ID = os.environ.get("CI_PROJECT_ID")
 CI_PIPELINE_ID = os.environ.get("CI_PIPELINE_ID")
 
 
+@lru_cache(maxsize=None)
+def slug(text):
+    """Slugify (Cached, Stages & Names Repeat Across Jobs)"""
+    return slugify(text)
+
+
 class GitlabJobsLogsDownloader:
     """Gitlab Jobs Logs Downloader"""
 
     def __init__(self):
-        self.session = requests.Session()
-        self.session.headers = {"PRIVATE-TOKEN": CI_API_TOKEN}
-        self.project = self.get_project()
-        self.project_name = self.project.json()["name"]
-        logging.info("GITLAB_PROJECT_NAME=%s", self.project.json()["name"])
-        self.pipeline_jobs = self.get_pipeline_jobs()
-        logging.info("RETRIEVING %s JOBS", len(self.pipeline_jobs))
-        self.download_pipeline_jobs_logs()
-
-    def get_project(self):
-        """Retrieve Gitlab Project"""
-        project = self.session.get(f"{CI_API_V4_URL}/projects/{CI_PROJECT_ID}")
-        if project.status_code != 200:
-            logging.error("UNKNOWN GITLAB PROJECT ID %s !", CI_PROJECT_ID)
+        self.directory = self.get_directory()
+        self.session = None
+        self.semaphore = asyncio.Semaphore(GITLAB_JOBS_LOGS_DOWNLOADER_MAX_CONCURRENCY)
+        self.project = None
+        self.project_name = None
+        self.filename_prefix = None
+        self.pipeline_jobs = []
+
+    @staticmethod
+    def get_directory():
+        """Create & Check Logs Directory"""
+        directory = Path(GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY)
+        try:
+            directory.mkdir(parents=True, exist_ok=True)
+        except OSError as error:
+            logging.critical(
+                "UNABLE TO CREATE GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY=%s (%s)",
+                GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY,
+                error.strerror,
+            )
             os._exit(1)
-        logging.debug("PROJECT=%s", project.json())
+        if not os.access(directory, os.W_OK | os.X_OK):
+            logging.critical(
+                "PERMISSION DENIED ON GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY=%s",
+                GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY,
+            )
+            os._exit(1)
+        return directory
+
+    async def run(self):
+        """Run Gitlab Jobs Logs Downloader"""
+        async with aiohttp.ClientSession(
+            headers={"PRIVATE-TOKEN": CI_API_TOKEN},
+            timeout=aiohttp.ClientTimeout(
+                total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+            ),
+            connector=aiohttp.TCPConnector(
+                limit=GITLAB_JOBS_LOGS_DOWNLOADER_MAX_CONCURRENCY + API_CONNECTIONS,
+                keepalive_timeout=60,
+            ),
+        ) as self.session:
+            self.project = await self.get_project()
+            self.project_name = self.project["name"]
+            self.filename_prefix = (
+                f"{slug(self.project_name)}"
+                f"{GITLAB_JOBS_LOGS_DOWNLOADER_FILENAME_DELIMITER}"
+            )
+            logging.info("GITLAB_PROJECT_NAME=%s", self.project_name)
+            self.pipeline_jobs = await self.get_pipeline_jobs()
+            logging.info("RETRIEVING %s JOBS", len(self.pipeline_jobs))
+            await self.download_pipeline_jobs_logs()
+
+    async def request(self, url, params=None):
+        """Request Gitlab API (Retry On Rate Limit & Server Errors)"""
+        retry = 0
+        while True:
+            response = await self.session.get(url, params=params)
+            if response.status not in RETRY_STATUS_CODES:
+                return response
+            if retry >= GITLAB_JOBS_LOGS_DOWNLOADER_MAX_RETRIES:
+                return response
+            try:
+                delay = float(response.headers.get("Retry-After", ""))
+            except ValueError:
+                delay = 2**retry
+            response.release()
+            logging.warning(
+                "HTTP %s ON %s, RETRYING IN %s SECONDS (%s/%s)",
+                response.status,
+                url,
+                delay,
+                retry + 1,
+                GITLAB_JOBS_LOGS_DOWNLOADER_MAX_RETRIES,
+            )
+            await asyncio.sleep(delay)
+            retry += 1
+
+    async def get_project(self):
+        """Retrieve Gitlab Project"""
+        async with await self.request(
+            f"{CI_API_V4_URL}/projects/{CI_PROJECT_ID}"
+        ) as response:
+            if response.status != 200:
+                logging.error("UNKNOWN GITLAB PROJECT ID %s !", CI_PROJECT_ID)
+                os._exit(1)
+            project = await response.json()
+        logging.debug("PROJECT=%s", project)
         return project
 
-    def get_pipeline_jobs(self):
+    async def get_pipeline_jobs(self):
         """Retrieve Gitlab Pipeline Jobs"""
         url = (
             f"{CI_API_V4_URL}/projects/{CI_PROJECT_ID}/pipelines/{CI_PIPELINE_ID}/jobs"
         )
+        # GitLab maximum page size, next page URLs keep this parameter
+        params = {"per_page": 100}
         pipeline_jobs = []
         while True:
-            response = self.session.get(url)
-            if response.status_code != 200:
-                logging.error(
-                    "UNKNOWN GITLAB PIPELINE ID %s FOR %s",
-                    CI_PIPELINE_ID,
-                    self.project_name,
-                )
-                os._exit(1)
-            pipeline_jobs.extend(response.json())
-            link_header = response.headers.get("Link")
-            if link_header:
-                next_page_url = self.extract_next_page_url(link_header)
-                if next_page_url:
-                    url = next_page_url
-                else:
-                    break
-            else:
+            async with await self.request(url, params=params) as response:
+                if response.status != 200:
+                    logging.error(
+                        "UNKNOWN GITLAB PIPELINE ID %s FOR %s",
+                        CI_PIPELINE_ID,
+                        self.project_name,
+                    )
+                    os._exit(1)
+                pipeline_jobs.extend(await response.json())
+                url = response.links.get("next", {}).get("url")
+                params = None
+            if not url:
                 break
         logging.debug("JOBS=%s", pipeline_jobs)
-        return sorted(pipeline_jobs, key=lambda x: x["id"])
+        pipeline_jobs.sort(key=itemgetter("id"))
+        return pipeline_jobs
 
-    @staticmethod
-    def extract_next_page_url(link_header):
-        """Extract Next Page URL"""
-        links = link_header.split(", ")
-        for link in links:
-            url, rel = link.split("; ")
-            url = url.strip("<>")
-            rel = rel.split("=")[1].strip('"')
-            if rel == "next":
-                return url
-        return None
-
-    def get_job(self, job_id):
+    async def get_job(self, job_id):
         """Get Job"""
-        response = self.session.get(
+        async with await self.request(
             f"{CI_API_V4_URL}/projects/{CI_PROJECT_ID}/jobs/{job_id}"
+        ) as response:
+            if response.status != 200:
+                return {}
+            job = await response.json()
+        logging.debug("JOB=%s", job)
+        return job
+
+    @staticmethod
+    def get_artifacts_types(job_artifacts):
+        """Get Job Artifacts File Types"""
+        return {artifact.get("file_type") for artifact in job_artifacts}
+
+    @staticmethod
+    def next_check_interval(interval):
+        """Next Job Check Interval (Capped Exponential Backoff)"""
+        return max(
+            1, min(GITLAB_JOBS_LOGS_DOWNLOADER_JOB_CHECK_INTERVAL_SECONDS, interval * 2)
         )
-        if response.status_code != 200:
-            return {}
-        logging.debug("JOB=%s", response.json())
-        return response.json()
 
-    def check_running_timeout(self, job_name, job_stage, job_id, job_status):
+    async def check_running_timeout(self, job_name, job_stage, job_id, job_status):
         """Check Running Timeout"""
         init = datetime.now()
+        interval = 1
         while job_status == "running":
             if (
                 datetime.now() - init
@@ -200,16 +315,17 @@ class GitlabJobsLogsDownloader:
                 job_stage,
                 self.project_name,
             )
-            time.sleep(GITLAB_JOBS_LOGS_DOWNLOADER_RUNNING_JOB_TIMEOUT_SECONDS)
-            job_status = self.get_job(job_id)["status"]
+            await asyncio.sleep(interval)
+            interval = self.next_check_interval(interval)
+            job_status = (await self.get_job(job_id)).get("status")
         return False
 
-    def check_end_timeout(self, job_name, job_stage, job_artifacts, job_id):
+    async def check_end_timeout(self, job_name, job_stage, job_artifacts, job_id):
         """Check End Timeout"""
         init = datetime.now()
-        while not any(
-            artifact.get("file_type") == "trace" for artifact in job_artifacts
-        ):
+        interval = 1
+        artifacts_types = self.get_artifacts_types(job_artifacts)
+        while "trace" not in artifacts_types:
             if (
                 datetime.now() - init
             ).total_seconds() >= GITLAB_JOBS_LOGS_DOWNLOADER_END_JOB_TIMEOUT_SECONDS:
@@ -226,83 +342,148 @@ class GitlabJobsLogsDownloader:
                 job_stage,
                 self.project_name,
             )
-            time.sleep(GITLAB_JOBS_LOGS_DOWNLOADER_JOB_CHECK_INTERVAL_SECONDS)
-            job_artifacts = self.get_job(job_id)["artifacts"]
+            await asyncio.sleep(interval)
+            interval = self.next_check_interval(interval)
+            job = await self.get_job(job_id)
+            artifacts_types = self.get_artifacts_types(job.get("artifacts", []))
         return False
 
-    def download_logs(self, job_name, job_stage, job_id):
-        """Download Job Logs"""
-        filename = (
-            f"{slugify(self.project_name)}"
-            f"{GITLAB_JOBS_LOGS_DOWNLOADER_FILENAME_DELIMITER}"
-            f"{slugify(job_stage)}"
-            f"{GITLAB_JOBS_LOGS_DOWNLOADER_FILENAME_DELIMITER}"
-            f"{slugify(job_name)}.log"
-        )
-        logs = self.session.get(
-            f"{CI_API_V4_URL}/projects/{CI_PROJECT_ID}/jobs/{job_id}/trace",
-            allow_redirects=True,
+    def get_filename(self, job_stage, job_name):
+        """Get Job Logs Filename"""
+        return (
+            f"{self.filename_prefix}{slug(job_stage)}"
+            f"{GITLAB_JOBS_LOGS_DOWNLOADER_FILENAME_DELIMITER}{slug(job_name)}.log"
         )
-        logging.info(
+
+    @staticmethod
+    def preallocate(f, response):
+        """Preallocate Job Logs File"""
+        # Content-Length is the size on disk only without Content-Encoding
+        if not hasattr(os, "posix_fallocate") or "Content-Encoding" in response.headers:
+            return
+        if response.content_length:
+            try:
+                os.posix_fallocate(f.fileno(), 0, response.content_length)
+            except OSError:
+                # Not supported by every filesystem
+                pass
+
+    async def download_logs(self, job_name, job_stage, job_id):
+        """Download Job Logs"""
+        filename = self.get_filename(job_stage, job_name)
+        logging.debug(
             'DOWNLOADING LOGS FOR JOB="%s" STAGE="%s" PROJECT="%s"',
             job_name,
             job_stage,
             self.project_name,
         )
-        if logs.status_code != 200:
+        async with self.semaphore, await self.request(
+            f"{CI_API_V4_URL}/projects/{CI_PROJECT_ID}/jobs/{job_id}/trace"
+        ) as logs:
+            if logs.status != 200:
+                logging.error(
+                    'UNABLE TO DOWNLOAD LOGS FOR JOB="%s" STAGE="%s" PROJECT="%s"',
+                    job_name,
+                    job_stage,
+                    self.project_name,
+                )
+                return
+            path = self.directory / filename
+            try:
+                with open(path, "wb", buffering=BUFFER_SIZE) as f:
+                    self.preallocate(f, logs)
+                    async for chunk in logs.content.iter_chunked(CHUNK_SIZE):
+                        f.write(chunk)
+                    # Drop preallocated space not filled by the trace
+                    f.truncate()
+                    size = f.tell()
+                logging.info(
+                    'JOB="%s" STAGE="%s" PROJECT="%s" DESTINATION=%s SIZE=%s',
+                    job_name,
+                    job_stage,
+                    self.project_name,
+                    path,
+                    size,
+                )
+            except PermissionError:
+                logging.critical(
+                    "PERMISSION DENIED ON GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY=%s",
+                    GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY,
+                )
+                os._exit(1)
+            except OSError as error:
+                path.unlink(missing_ok=True)
+                logging.critical("UNABLE TO WRITE %s (%s)", path, error.strerror)
+                os._exit(1)
+            except BaseException:
+                # Do not leave a partial (possibly preallocated) trace behind
+                path.unlink(missing_ok=True)
+                raise
+
+    async def download_pipeline_job_logs(self, pipeline_job):
+        """Download Gitlab Pipeline Job Logs (Failures Do Not Stop Other Jobs)"""
+        try:
+            await self.process_pipeline_job(pipeline_job)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
             logging.error(
-                'UNABLE TO DOWNLOAD LOGS FOR JOB="%s" STAGE="%s" PROJECT="%s"',
+                'UNABLE TO DOWNLOAD LOGS FOR JOB="%s" STAGE="%s" PROJECT="%s" (%r)',
+                pipeline_job["name"],
+                pipeline_job["stage"],
+                self.project_name,
+                error,
+            )
+
+    async def process_pipeline_job(self, pipeline_job):
+        """Process Gitlab Pipeline Job"""
+        job_id = pipeline_job["id"]
+        job_artifacts = pipeline_job["artifacts"]
+        job_stage = pipeline_job["stage"]
+        job_name = pipeline_job["name"]
+        job_status = pipeline_job["status"]
+
+        if job_status in ["pending", "manual", "scheduled", "skipped", "created"]:
+            logging.info(
+                'JOB="%s" STAGE="%s" PROJECT="%s" STATUS="%s" SKIP !',
                 job_name,
                 job_stage,
                 self.project_name,
+                job_status,
             )
             return
-        try:
-            with open(f"{GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY}/{filename}", "wb") as f:
-                f.write(logs.content)
-            logging.info(
-                "DESTINATION=%s/%s", GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY, filename
-            )
-        except FileNotFoundError:
-            logging.critical(
-                "NO SUCH DIRECTORY GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY=%s",
-                GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY,
-            )
-            os._exit(1)
-        except PermissionError:
-            logging.critical(
-                "PERMISSION DENIED ON GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY=%s",
-                GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY,
+
+        has_trace = "trace" in self.get_artifacts_types(job_artifacts)
+        if job_status == "canceled" and not has_trace:
+            logging.warning(
+                'NO LOGS FOR JOB="%s" STAGE="%s" PROJECT="%s" STATUS="%s"',
+                job_name,
+                job_stage,
+                self.project_name,
+                job_status,
             )
-            os._exit(1)
+            return
 
-    def download_pipeline_jobs_logs(self):
-        """Download Gitlab Pipeline Jobs Logs"""
-        for pipeline_job in self.pipeline_jobs:
-            job_id = pipeline_job["id"]
-            job = self.get_job(job_id)
-            job_artifacts = job["artifacts"]
-            job_stage = job["stage"]
-            job_name = job["name"]
-            job_status = job["status"]
-
-            if job_status in ["pending", "manual", "scheduled", "skipped", "created"]:
-                logging.info(
-                    'JOB="%s" STAGE="%s" PROJECT="%s" STATUS="%s" SKIP !',
-                    job_name,
-                    job_stage,
-                    self.project_name,
-                    job_status,
-                )
-                continue
+        # Traces of finished jobs are archived asynchronously, wait for them
+        if not has_trace or job_status not in ["success", "failed", "canceled"]:
+            if await self.check_running_timeout(
+                job_name, job_stage, job_id, job_status
+            ):
+                return
 
-            if self.check_running_timeout(job_name, job_stage, job_id, job_status):
-                continue
+            if await self.check_end_timeout(
+                job_name, job_stage, job_artifacts, job_id
+            ):
+                return
 
-            if self.check_end_timeout(job_name, job_stage, job_artifacts, job_id):
-                continue
+        await self.download_logs(job_name, job_stage, job_id)
 
-            self.download_logs(job_name, job_stage, job_id)
+    async def download_pipeline_jobs_logs(self):
+        """Download Gitlab Pipeline Jobs Logs"""
+        async with asyncio.TaskGroup() as tg:
+            for pipeline_job in self.pipeline_jobs:
+                tg.create_task(self.download_pipeline_job_logs(pipeline_job))
+        # Logs files are not fsynced one by one (it would serialize writes),
+        # they are only guaranteed to be on disk after this single sync
+        os.sync()
 
 
 def main():
@@ -314,7 +495,7 @@ def main():
         "GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY=%s",
         GITLAB_JOBS_LOGS_DOWNLOADER_DIRECTORY,
     )
-    GitlabJobsLogsDownloader()
+    asyncio.run(GitlabJobsLogsDownloader().run())
 
 
 if __name__ == "__main__":